@@ -12,20 +12,26 @@ import logging
 from datetime import datetime
 from pathlib import Path
 import sys
-import warnings
 import os
 
-# Unterdrücke VTK/ParaView Warnings
-warnings.filterwarnings('ignore')
+# Unterdrücke VTK/ParaView Warnings (im Speicher, ohne Datei-I/O)
 os.environ['VTK_SILENCE_GET_VOID_POINTER_WARNINGS'] = '1'
 
 import vtk
 vtk.vtkObject.GlobalWarningDisplayOff()
-vtk_output_window = vtk.vtkFileOutputWindow()
-vtk_output_window.SetFileName('/dev/null')
+vtk_output_window = vtk.vtkStringOutputWindow()
 vtk.vtkOutputWindow.SetInstance(vtk_output_window)
 
 
+def enable_vtk_log(log_file):
+    """Schreibe VTK-Warnings zum Debuggen in eine Datei"""
+    global vtk_output_window
+    vtk_output_window = vtk.vtkFileOutputWindow()
+    vtk_output_window.SetFileName(str(log_file))
+    vtk.vtkOutputWindow.SetInstance(vtk_output_window)
+    vtk.vtkObject.GlobalWarningDisplayOn()
+
+
 def format_number(num):
     """Formatiere Zahlen lesbar (z.B. 62.1M statt 62134485)"""
     if num >= 1_000_000:
@@ -35,6 +41,56 @@ def format_number(num):
     return str(num)
 
 
+def available_cpus():
+    """Anzahl nutzbarer CPUs (berücksichtigt CPU-Affinität, z.B. taskset/Slurm)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def setup_smp():
+    """
+    Aktiviere Multithreading der VTK-Filter (TBB, sonst STDThread)
+
+    Eine explizit gesetzte VTK_SMP_MAX_THREADS wird nicht überschrieben.
+    """
+    smp = getattr(vtk, 'vtkSMPTools', None)
+    if smp is None:
+        return 'unbekannt', 'unbekannt'
+    if not hasattr(smp, 'SetBackend'):
+        # Ältere VTK: Backend fest einkompiliert und nicht abfragbar
+        if hasattr(smp, 'GetEstimatedNumberOfThreads'):
+            return 'unbekannt', smp.GetEstimatedNumberOfThreads()
+        return 'unbekannt', 'unbekannt'
+
+    if not smp.SetBackend('TBB'):
+        smp.SetBackend('STDThread')
+    if os.environ.get('VTK_SMP_MAX_THREADS'):
+        smp.Initialize()
+    else:
+        smp.Initialize(available_cpus())
+    return smp.GetBackend(), smp.GetEstimatedNumberOfThreads()
+
+
+def box_overlaps(bounds, xmin, xmax, ymin, ymax, zmin, zmax):
+    """Prüfe ob die Box die Mesh-Bounds (xmin, xmax, ymin, ymax, zmin, zmax) schneidet"""
+    return (xmin <= bounds[1] and xmax >= bounds[0] and
+            ymin <= bounds[3] and ymax >= bounds[2] and
+            zmin <= bounds[5] and zmax >= bounds[4])
+
+
+def release_when_consumed(proxy):
+    """Gib den Output eines Filters frei, sobald der nachfolgende Filter gelaufen ist"""
+    proxy.GetClientSideObject().ReleaseDataFlagOn()
+
+
+def set_box(box, xmin, xmax, ymin, ymax, zmin, zmax):
+    """Konfiguriere eine achsenparallele Box (implizite Funktion eines Filters)"""
+    box.Position = [xmin, ymin, zmin]
+    box.Length = [xmax - xmin, ymax - ymin, zmax - zmin]
+    box.Rotation = [0.0, 0.0, 0.0]
+
+
 def setup_logging():
     """Setup Logging-System (Datei + Console)"""
     log_dir = Path('logs')
@@ -66,7 +122,17 @@ def setup_logging():
 
 
 def get_system_info():
-    """Lese System-Ressourcen aus /proc/meminfo"""
+    """Lese System-Ressourcen via psutil (Fallback: /proc/meminfo)"""
+    try:
+        import psutil
+        vm = psutil.virtual_memory()
+        return {
+            'total_gb': vm.total / (1024 ** 3),
+            'available_gb': vm.available / (1024 ** 3)
+        }
+    except ImportError:
+        pass
+
     try:
         with open('/proc/meminfo', 'r') as f:
             lines = f.readlines()
@@ -95,6 +161,21 @@ def should_tetrahedralize(box_volume, available_ram_gb):
         return box_volume <= 500
 
 
+def select_arrays(logger, reader, arrays):
+    """Lade nur die gewünschten Variablen - alle anderen werden nie gelesen"""
+    reader.UpdatePipelineInformation()
+    point_arrays = [name for name in reader.PointArrays.Available if name in arrays]
+    cell_arrays = [name for name in reader.CellArrays.Available if name in arrays]
+
+    missing = set(arrays) - set(point_arrays) - set(cell_arrays)
+    if missing:
+        logger.warning(f"  Variablen nicht gefunden: {', '.join(sorted(missing))}")
+
+    reader.PointArrays = point_arrays
+    reader.CellArrays = cell_arrays
+    logger.info(f"  Variablen: {', '.join(point_arrays + cell_arrays) or 'keine'}")
+
+
 def parse_args():
     """Parse Kommandozeilenargumente"""
     parser = argparse.ArgumentParser(
@@ -105,6 +186,7 @@ Beispiele:
   pvbatch clip_box.py
   pvbatch clip_box.py --xmin=-5 --xmax=8 --ymin=-3 --ymax=3
   pvbatch clip_box.py --force-tetra
+  pvbatch clip_box.py --arrays=pressure,velocity
   ./run_clip_background.sh --xmin=-10 --xmax=10
         """
     )
@@ -125,25 +207,38 @@ Beispiele:
 
     # Processing-Optionen
     parser.add_argument('--force-tetra', action='store_true',
-                        help='Erzwinge Tetrahedralisierung')
+                        help='Tetrahedralisiere das Ergebnis (default: aus)')
     parser.add_argument('--no-tetra', action='store_true',
-                        help='Überspringe Tetrahedralisierung')
+                        help='Überspringe Tetrahedralisierung (default)')
     parser.add_argument('--exact-clip', action='store_true',
                         help='Exakte Schnitte (LANGSAM!)')
+    parser.add_argument('--merge-points', action='store_true',
+                        help='Doppelte Punkte beim Merge Blocks zusammenführen (langsamer)')
+    parser.add_argument('--allow-empty', action='store_true',
+                        help='Auch exportieren, wenn die Box das Mesh nicht schneidet')
+    parser.add_argument('--vtk-log', metavar='DATEI',
+                        help='VTK-Warnings in Datei schreiben (Debug)')
+    parser.add_argument('--arrays', type=lambda s: [a.strip() for a in s.split(',') if a.strip()],
+                        help='Nur diese Variablen laden, kommagetrennt (default: alle)')
 
     return parser.parse_args()
 
 
 def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
-             output_dir, force_tetra=False, no_tetra=False, exact_clip=False):
+             output_dir, force_tetra=False, no_tetra=False, exact_clip=False,
+             arrays=None, merge_points=False,
+             allow_empty=False):
     """
     Hauptfunktion: Clippe Box aus EnSight-Daten
 
+    Gibt den Output-Pfad zurück, oder None wenn die Box das Mesh nicht
+    schneidet (ohne --allow-empty).
+
     Workflow:
-    1. Lade EnSight Daten
+    1. Lade EnSight Daten (optional nur ausgewählte Variablen)
     2. Clippe Box
     3. Bereinige Mesh (CleantoGrid)
-    4. Optional: Tetrahedralisiere
+    4. Optional: Tetrahedralisiere (nur mit --force-tetra)
     5. Merge Blocks
     6. Exportiere als EnSight Gold
     """
@@ -156,6 +251,8 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
     # System-Info
     mem_info = get_system_info()
     logger.info(f"System: {mem_info['total_gb']:.0f}GB RAM ({mem_info['available_gb']:.0f}GB verfügbar)")
+    smp_backend, smp_threads = setup_smp()
+    logger.info(f"VTK SMP: {smp_backend} ({smp_threads} Threads)")
 
     # Box-Info
     box_width = xmax - xmin
@@ -165,13 +262,11 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
     logger.info(f"Box: {box_width:.0f}x{box_height:.0f}x{box_depth:.0f}m = {box_volume:.0f}m³")
     logger.info(f"Box-Position: X[{xmin:.1f}, {xmax:.1f}] Y[{ymin:.1f}, {ymax:.1f}] Z[{zmin:.1f}, {zmax:.1f}]")
 
-    # Entscheide über Tetrahedralisierung
-    use_tetra = should_tetrahedralize(box_volume, mem_info['available_gb'])
-    if force_tetra:
-        use_tetra = True
-    if no_tetra:
-        use_tetra = False
+    # Tetrahedralisierung nur auf Wunsch - EnSight Gold braucht keine Tetraeder
+    use_tetra = force_tetra and not no_tetra
     logger.info(f"Tetrahedralisierung: {'JA' if use_tetra else 'NEIN'}")
+    if use_tetra and not should_tetrahedralize(box_volume, mem_info['available_gb']):
+        logger.warning("  Box für Tetrahedralisierung sehr groß - hoher RAM-Bedarf!")
     logger.info("")
 
     # 1. LADE ENSIGHT
@@ -181,6 +276,8 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
 
     step_time = time.time()
     reader = EnSightReader(CaseFileName=input_file)
+    if arrays is not None:
+        select_arrays(logger, reader, arrays)
     reader.UpdatePipeline()
 
     info = reader.GetDataInformation()
@@ -188,20 +285,55 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
     original_cells = info.GetNumberOfCells()
     logger.info(f"  Geladen: {format_number(original_points)} Punkte, {format_number(original_cells)} Zellen ({time.time()-step_time:.1f}s)")
 
+    # Leeres Input hat keine gültigen Bounds (±1e299) - vorher prüfen
+    problem = None
+    if original_cells == 0:
+        problem = "Input enthält keine Zellen"
+    else:
+        bounds = info.GetBounds()
+        if not box_overlaps(bounds, xmin, xmax, ymin, ymax, zmin, zmax):
+            problem = f"Box liegt außerhalb des Meshes X[{bounds[0]:.1f}, {bounds[1]:.1f}] Y[{bounds[2]:.1f}, {bounds[3]:.1f}] Z[{bounds[4]:.1f}, {bounds[5]:.1f}]"
+
+    if problem:
+        if not allow_empty:
+            logger.error(f"  {problem} (--allow-empty für leeren Export)")
+            Delete(reader)
+            return None
+        logger.warning(f"  {problem} - Ergebnis ist leer")
+
     # 2. CLIPPE BOX
     logger.info("Clippe Box...")
     if exact_clip:
         logger.warning("  EXACT CLIP aktiviert - kann STUNDEN dauern!")
 
     step_time = time.time()
-    clip = Clip(Input=reader)
-    clip.ClipType = 'Box'
-    clip.ClipType.Position = [xmin, ymin, zmin]
-    clip.ClipType.Length = [box_width, box_height, box_depth]
-    clip.ClipType.Rotation = [0.0, 0.0, 0.0]
-    clip.Invert = 1
-    clip.Crinkleclip = 0 if exact_clip else 1
-    clip.UpdatePipeline()
+    release_when_consumed(reader)
+
+    # Crinkle-Clip: ganze Zellen behalten/verwerfen (vtkExtractGeometry),
+    # keine Interpolation der Punktdaten
+    clip = ExtractCellsByRegion(Input=reader)
+    clip.IntersectWith = 'Box'
+    set_box(clip.IntersectWith, xmin, xmax, ymin, ymax, zmin, zmax)
+    clip.Extractinside = 1
+    clip.Extractintersected = 1
+
+    if exact_clip:
+        # Exakter Schnitt nur auf den vorgefilterten Zellen: Zellen werden an
+        # der Box geteilt, Punktdaten interpoliert
+        clip.UpdatePipeline()
+        prefilter = clip
+
+        release_when_consumed(prefilter)
+        clip = Clip(Input=prefilter)
+        clip.ClipType = 'Box'
+        set_box(clip.ClipType, xmin, xmax, ymin, ymax, zmin, zmax)
+        clip.Invert = 1
+        clip.Crinkleclip = 0
+        clip.UpdatePipeline()
+
+        Delete(prefilter)
+    else:
+        clip.UpdatePipeline()
 
     info = clip.GetDataInformation()
     clipped_points = info.GetNumberOfPoints()
@@ -210,9 +342,10 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
 
     current = clip
 
-    # 3. BEREINIGE MESH
+    # 3. BEREINIGE MESH (EnSightReader liefert immer Multiblock - blockweise)
     logger.info("Bereinige Mesh (CleantoGrid)...")
     step_time = time.time()
+    release_when_consumed(current)
     clean = CleantoGrid(Input=current)
     clean.UpdatePipeline()
 
@@ -228,6 +361,7 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
         logger.info("Tetrahedralisiere...")
         step_time = time.time()
 
+        release_when_consumed(current)
         tetra = Tetrahedralize(Input=current)
         tetra.UpdatePipeline()
 
@@ -238,15 +372,21 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
         Delete(current)
         current = tetra
 
-    # 5. MERGE BLOCKS
+    # 5. MERGE BLOCKS (EnSightReader liefert immer Multiblock, der
+    #    EnSight-Writer braucht ein einzelnes vtkUnstructuredGrid)
     logger.info("Merge Blocks...")
     step_time = time.time()
+    release_when_consumed(current)
     merge = MergeBlocks(Input=current)
+    # Multiblock wurde oben bereits blockweise von CleantoGrid bereinigt;
+    # doppelte Punkte gibt es nur an Part-Grenzen - Punkt-Merge kostet viel
+    merge.MergePoints = 1 if merge_points else 0
     merge.UpdatePipeline()
 
     Delete(current)
+    current = merge
 
-    info = merge.GetDataInformation()
+    info = current.GetDataInformation()
     final_points = info.GetNumberOfPoints()
     final_cells = info.GetNumberOfCells()
     logger.info(f"  Final: {format_number(final_points)} Punkte, {format_number(final_cells)} Zellen ({time.time()-step_time:.1f}s)")
@@ -267,7 +407,7 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
     ensight_case = str(output_path / "clipped.case")
 
     step_time = time.time()
-    writer = CreateWriter(ensight_case, merge)
+    writer = CreateWriter(ensight_case, current)
     writer.UpdatePipeline()
     del writer
     logger.info(f"  Export erfolgreich ({time.time()-step_time:.1f}s)")
@@ -283,7 +423,7 @@ def clip_box(logger, input_file, xmin, xmax, ymin, ymax, zmin, zmax,
     logger.info("="*70)
 
     # Cleanup
-    Delete(merge)
+    Delete(current)
     Delete(reader)
 
     return str(output_path)
@@ -295,8 +435,10 @@ def main():
 
     try:
         args = parse_args()
+        if args.vtk_log:
+            enable_vtk_log(args.vtk_log)
 
-        clip_box(
+        output = clip_box(
             logger=logger,
             input_file=args.input,
             xmin=args.xmin, xmax=args.xmax,
@@ -305,9 +447,12 @@ def main():
             output_dir=args.output_dir,
             force_tetra=args.force_tetra,
             no_tetra=args.no_tetra,
-            exact_clip=args.exact_clip
+            exact_clip=args.exact_clip,
+            arrays=args.arrays,
+            merge_points=args.merge_points,
+            allow_empty=args.allow_empty
         )
-        return 0
+        return 0 if output else 1
 
     except Exception as e:
         logger.error(f"FEHLER: {e}", exc_info=True)